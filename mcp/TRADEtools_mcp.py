@@ -1,8 +1,3 @@
-# Fix multiprocessing deadlock in asyncio context
-# Must be called before any other imports
-import multiprocessing
-multiprocessing.set_start_method("spawn", force=True)
-
 """
 Model Context Protocol (MCP) for TRADEtools
 
@@ -13,20 +8,36 @@ adaptive shrinkage, and computes correlation between perturbation effects in biv
 
 This MCP Server provides Python interfaces to R tools extracted from the following tutorial files:
 1. tradetools_intro
-    - trade_univariate: Run univariate TRADE analysis to estimate transcriptome-wide impact (calls R via Rscript)
-    - trade_bivariate: Run bivariate TRADE analysis to estimate correlation between perturbations (calls R via Rscript)
+    - trade_univariate: Run univariate TRADE analysis to estimate transcriptome-wide impact (calls R via a persistent worker)
+    - trade_bivariate: Run bivariate TRADE analysis to estimate correlation between perturbations (calls R via a persistent worker)
 
-Note: All tools execute R code via Rscript subprocess calls. Ensure R is installed
+Note: All tools execute R code in long-lived Rscript processes (tools/r_worker.py) that load
+the R packages once and then serve jobs over stdin/stdout; on POSIX systems a single R master
+forks one child per job. Ensure R is installed
 and the TRADEtools package dependencies are available in the renv environment at repo/TRADEtools/.
 """
 
+from contextlib import asynccontextmanager
+
 from mcp.server.fastmcp import FastMCP
 
 # Import tool functions from modules
 from tools.tradetools_intro import trade_univariate, trade_bivariate
+from tools.r_worker import worker_pool
+
+
+@asynccontextmanager
+async def lifespan(server):
+    # Warm-start the R workers so the first tool call does not pay for package loading
+    await worker_pool.start()
+    try:
+        yield
+    finally:
+        await worker_pool.close()
+
 
 # Server definition
-mcp = FastMCP(name="TRADEtools")
+mcp = FastMCP(name="TRADEtools", lifespan=lifespan)
 
 # Register tools on the unified server
 mcp.tool()(trade_univariate)
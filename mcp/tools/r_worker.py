@@ -0,0 +1,528 @@
+"""Persistent R worker processes for the TRADEtools MCP tools"""
+
+import asyncio
+import atexit
+import itertools
+import json
+import os
+import shutil
+import signal
+import tempfile
+import time
+from abc import ABC, abstractmethod
+from pathlib import Path
+
+# Point to the R scripts directory for this tutorial
+R_SCRIPT_DIR = Path(__file__).parent.parent / "r_scripts" / "tradetools_intro"
+
+# Worker entry point; it sources the tool scripts and serves jobs over stdin/stdout
+WORKER_SCRIPT = R_SCRIPT_DIR / "trade_worker.R"
+
+# Check the R sources once at import rather than failing inside every worker start
+for _script in ("trade_worker.R", "trade_univariate.R", "trade_bivariate.R", "trade_io.R"):
+    if not (R_SCRIPT_DIR / _script).is_file():
+        raise FileNotFoundError(f"TRADE R script not found: {R_SCRIPT_DIR / _script}")
+
+# Replies from the worker are single lines prefixed with the ASCII record separator
+RECORD_SEPARATOR = b"\x1e"
+
+# Worker R sessions skip profile/environ files and the graphics/datasets default packages
+RSCRIPT_FLAGS = ("--vanilla", "--default-packages=methods,stats,utils")
+
+# Full worker command line, built once
+_WORKER_CMD = ("Rscript", *RSCRIPT_FLAGS, str(WORKER_SCRIPT))
+
+# Upper bound on concurrent R workers; each one holds its own copy of mashr in memory
+MAX_WORKERS = int(os.environ.get("TRADE_MCP_MAX_WORKERS", "4"))
+
+# Seconds a worker may sit idle before it is shut down to free memory
+WORKER_IDLE_TIMEOUT = float(os.environ.get("TRADE_MCP_WORKER_IDLE_TIMEOUT", "600"))
+
+# Bytes of R stderr kept per process for error messages
+STDERR_TAIL_BYTES = 64 * 1024
+
+# Seconds a forked child may take to open its reply FIFO before it is presumed stuck
+CHILD_ACK_TIMEOUT = 60
+
+# Longest stdout line read from R; replies carry sample summaries that can be large
+STREAM_LIMIT = 16 * 1024 * 1024
+
+# Fork jobs off a single R master where fork() exists; set TRADE_MCP_FORK=0 to opt out
+USE_FORK = os.name == "posix" and os.environ.get("TRADE_MCP_FORK", "1") != "0"
+
+
+_worker_env = None
+_worker_env_lock = asyncio.Lock()
+
+
+async def r_worker_env() -> dict:
+    """
+    Environment for worker processes, resolved once per server.
+
+    --vanilla also skips .Rprofile (and with it renv activation), so the library paths a
+    normal R session would see are looked up once and passed to every worker via R_LIBS.
+    R_COMPILE_PKGS makes any package installed from within a worker byte-compiled.
+    """
+    global _worker_env
+    async with _worker_env_lock:
+        if _worker_env is None:
+            proc = await asyncio.create_subprocess_exec(
+                "Rscript", "-e",
+                'cat("\\x1e", paste(.libPaths(), collapse = .Platform$path.sep), "\\n", sep = "")',
+                stdout=asyncio.subprocess.PIPE,
+            )
+            stdout, _ = await proc.communicate()
+            if proc.returncode:
+                raise RuntimeError(f"Failed to query R library paths (exit code {proc.returncode})")
+            lib_paths = [line for line in stdout.splitlines() if line.startswith(RECORD_SEPARATOR)][-1]
+            _worker_env = {
+                **os.environ,
+                "R_LIBS": lib_paths[len(RECORD_SEPARATOR):].decode(),
+                "R_COMPILE_PKGS": "1",
+            }
+    return _worker_env
+
+
+async def _read_record(stream: asyncio.StreamReader) -> dict | None:
+    """Read the next record-separator framed reply, skipping other output; None at EOF."""
+    while line := await stream.readline():
+        # Output from concurrent jobs may share a line with a reply, so search rather than match
+        start = line.find(RECORD_SEPARATOR)
+        if start >= 0:
+            return json.loads(line[start + len(RECORD_SEPARATOR):])
+    return None
+
+
+class _StderrTail:
+    """
+    Drains a process's stderr into a ring buffer holding only the last STDERR_TAIL_BYTES.
+
+    R diagnostics can be voluminous (mashr especially); draining keeps the pipe from
+    filling up and blocking R, and keeps the output out of the MCP server's own streams.
+    """
+
+    def __init__(self, stream: asyncio.StreamReader):
+        self._buffer = bytearray()
+        self._written = 0
+        self._task = asyncio.create_task(self._drain(stream))
+
+    async def _drain(self, stream: asyncio.StreamReader):
+        while chunk := await stream.read(STDERR_TAIL_BYTES):
+            self._written += len(chunk)
+            self._buffer += chunk
+            del self._buffer[:-STDERR_TAIL_BYTES]
+
+    def mark(self) -> int:
+        """Current position in the stream, to pass as format(since=...) when a job starts."""
+        return self._written
+
+    async def format(self, message: str, since: int | None = None, shared: bool = False) -> str:
+        """
+        Append the captured stderr, if any, to an error message.
+
+        With since, only output written after that mark is included, so a job's error does
+        not carry package-load noise or earlier jobs' warnings; shared labels it as possibly
+        including output of concurrent jobs. Yields first so output already sent is drained.
+        """
+        await asyncio.sleep(0)
+        tail = self._buffer
+        label = f"R stderr (last {STDERR_TAIL_BYTES // 1024} KB)"
+        if since is not None:
+            tail = tail[len(tail) - min(self._written - since, len(tail)):]
+            label = "R stderr since this job started"
+            if shared:
+                label += " (shared by concurrent jobs)"
+        tail = tail.decode(errors="replace").strip()
+        return f"{message}\n--- {label} ---\n{tail}" if tail else message
+
+
+async def _spawn(*flags: str) -> tuple[asyncio.subprocess.Process, _StderrTail]:
+    """Start trade_worker.R with piped stdin/stdout and a captured stderr tail."""
+    proc = await asyncio.create_subprocess_exec(
+        *_WORKER_CMD, *flags,
+        stdin=asyncio.subprocess.PIPE,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE,
+        env=await r_worker_env(),
+        limit=STREAM_LIMIT,
+    )
+    return proc, _StderrTail(proc.stderr)
+
+
+async def _exited(proc: asyncio.subprocess.Process) -> int:
+    """
+    Wait for an R process to exit and return its exit code.
+
+    Unlike proc.wait(), this does not also wait for its pipes to close, which forked
+    children that inherited them may hold open long after the process itself is gone.
+    """
+    while proc.returncode is None:
+        await asyncio.sleep(0.1)
+    return proc.returncode
+
+
+async def _stop_process(proc: asyncio.subprocess.Process):
+    """Close an R process's stdin so it exits, killing it if it does not."""
+    proc.stdin.close()
+    try:
+        await asyncio.wait_for(_exited(proc), timeout=10)
+    except asyncio.TimeoutError:
+        proc.kill()
+        await _exited(proc)
+
+
+class _IdleReaper(ABC):
+    """Background task that periodically calls _stop_idle() to shut down unused R processes."""
+
+    idle_timeout: float
+    _reaper = None
+
+    def _ensure_reaper(self):
+        if self._reaper is None or self._reaper.done():
+            self._reaper = asyncio.create_task(self._reap_idle())
+
+    def _cancel_reaper(self):
+        if self._reaper is not None:
+            self._reaper.cancel()
+            self._reaper = None
+
+    async def _reap_idle(self):
+        while True:
+            await asyncio.sleep(min(self.idle_timeout, 60))
+            await self._stop_idle(time.monotonic())
+
+    @abstractmethod
+    async def _stop_idle(self, now: float):
+        """Stop processes that have been idle for longer than idle_timeout as of now."""
+
+
+class RWorker:
+    """
+    A long-lived Rscript process running trade_worker.R.
+
+    R and the TRADEtools/ashr/mashr packages are loaded once when the process starts,
+    so each call only pays for the analysis itself. The process is (re)started lazily
+    and exits on its own when its stdin is closed. All I/O is asynchronous so the MCP
+    event loop keeps serving other requests while R is busy.
+    """
+
+    def __init__(self):
+        self._proc = None
+        self._stderr = None
+        self._lock = asyncio.Lock()
+        self.last_used = time.monotonic()
+
+    @property
+    def running(self) -> bool:
+        return self._proc is not None and self._proc.returncode is None
+
+    @property
+    def busy(self) -> bool:
+        return self._lock.locked()
+
+    async def _read_reply(self, since: int | None = None) -> dict:
+        reply = await _read_record(self._proc.stdout)
+        if reply is None:
+            code = await self._proc.wait()
+            raise RuntimeError(await self._stderr.format(f"R worker exited unexpectedly with code {code}", since))
+        return reply
+
+    async def _ensure_started(self):
+        if not self.running:
+            self._proc, self._stderr = await _spawn()
+            # The worker announces itself once its packages are loaded
+            await self._read_reply()
+
+    async def start(self):
+        """Start the R process (if needed) and wait until its packages are loaded."""
+        async with self._lock:
+            await self._ensure_started()
+
+    async def stop(self):
+        """Shut the R process down by closing its stdin; it is restarted on next use."""
+        async with self._lock:
+            if self.running:
+                await _stop_process(self._proc)
+
+    def _discard(self):
+        """Kill the R process without waiting; it is restarted on next use."""
+        if self.running:
+            self._proc.kill()
+        self._proc = None
+
+    async def call(self, job: str, args: dict) -> dict:
+        """Run a job ("univariate" or "bivariate") and return its summary result."""
+        async with self._lock:
+            try:
+                await self._ensure_started()
+                since = self._stderr.mark()
+                self._proc.stdin.write(json.dumps({"job": job, "args": args}).encode() + b"\n")
+                await self._proc.stdin.drain()
+                reply = await self._read_reply(since)
+            except BaseException:
+                # A cancelled or failed call may leave its job running in R, and the next
+                # call would read that job's reply as its own, so start over with a new process
+                self._discard()
+                raise
+            self.last_used = time.monotonic()
+
+        if "error" in reply:
+            raise RuntimeError(await self._stderr.format(f"TRADE {job} analysis failed: {reply['error']}", since))
+        return reply["result"]
+
+
+class RWorkerPool(_IdleReaper):
+    """
+    A fixed set of RWorkers shared by all tool calls.
+
+    TRADE's fitting steps are single-threaded in R, so concurrent calls are spread over
+    independent worker processes. Idle workers are handed out LIFO so warm processes are
+    reused, and a background reaper stops workers that have been idle for too long.
+    """
+
+    def __init__(self, size: int = min(os.cpu_count() or 1, MAX_WORKERS),
+                 idle_timeout: float = WORKER_IDLE_TIMEOUT):
+        self.idle_timeout = idle_timeout
+        self._workers = [RWorker() for _ in range(max(size, 1))]
+        self._idle = asyncio.LifoQueue()
+        for worker in self._workers:
+            self._idle.put_nowait(worker)
+
+    async def _stop_idle(self, now: float):
+        for worker in self._workers:
+            if worker.running and not worker.busy and now - worker.last_used > self.idle_timeout:
+                await worker.stop()
+
+    async def start(self):
+        """Warm-start every worker so the first real calls do not pay for R startup."""
+        self._ensure_reaper()
+        await asyncio.gather(*(worker.start() for worker in self._workers))
+
+    async def close(self):
+        """Stop the reaper and all worker processes."""
+        self._cancel_reaper()
+        await asyncio.gather(*(worker.stop() for worker in self._workers))
+
+    async def acquire(self) -> RWorker:
+        """Take an idle worker, waiting for one to free up if necessary."""
+        self._ensure_reaper()
+        return await self._idle.get()
+
+    def release(self, worker: RWorker):
+        """Return a worker obtained from acquire() to the pool."""
+        self._idle.put_nowait(worker)
+
+    async def call(self, job: str, args: dict) -> dict:
+        """Run a job on the next idle worker."""
+        worker = await self.acquire()
+        try:
+            return await worker.call(job, args)
+        finally:
+            self.release(worker)
+
+
+class _ReplyChannel:
+    """
+    A FIFO a forked child writes its job's reply to.
+
+    Each job gets its own channel, so replies of any size never interleave with those of
+    other children, and the channel closes when the child exits: EOF without a reply means
+    the child died (e.g. killed by the OOM killer) rather than that its job is still running.
+    The child acknowledges with one byte when it has opened the FIFO; until then a write
+    end held here keeps the reader from seeing EOF.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        os.mkfifo(path, 0o600)
+        self._keepalive = None
+        self._transport = None
+        self._reader = None
+
+    async def open(self):
+        read_fd = os.open(self.path, os.O_RDONLY | os.O_NONBLOCK)
+        self._keepalive = os.open(self.path, os.O_WRONLY | os.O_NONBLOCK)
+        self._reader = asyncio.StreamReader()
+        self._transport, _ = await asyncio.get_running_loop().connect_read_pipe(
+            lambda: asyncio.StreamReaderProtocol(self._reader), os.fdopen(read_fd, "rb", buffering=0))
+
+    async def wait_opened(self):
+        """Wait for the child's acknowledgement, after which EOF means the child has exited."""
+        await self._reader.readexactly(1)
+        os.close(self._keepalive)
+        self._keepalive = None
+
+    async def read_reply(self) -> dict | None:
+        """Read the reply written by the child; None if it exited without writing one."""
+        data = await self._reader.read()
+        start = data.find(RECORD_SEPARATOR)
+        if start < 0 or not data.endswith(b"\n"):
+            return None
+        return json.loads(data[start + len(RECORD_SEPARATOR):])
+
+    def close(self):
+        if self._keepalive is not None:
+            os.close(self._keepalive)
+        if self._transport is not None:
+            self._transport.close()
+        os.unlink(self.path)
+
+
+def _kill_child(pid: int):
+    """Kill a forked R child that may still be running a job nobody waits for."""
+    try:
+        os.kill(pid, signal.SIGKILL)
+    except ProcessLookupError:
+        pass
+
+
+class _ForkMaster:
+    """An R master process and the jobs dispatched to it that have not finished yet."""
+
+    def __init__(self, proc: asyncio.subprocess.Process, stderr: _StderrTail):
+        self.proc = proc
+        self.stderr = stderr
+        # Resolved by the master's reply to each job: the forked child's pid, or an error
+        # if it could not fork; failed if the master exits first
+        self.pending: dict[int, asyncio.Future] = {}
+        # Jobs whose caller gave up before the master reported their child's pid
+        self.abandoned: set[int] = set()
+
+
+class RForkServer(_IdleReaper):
+    """
+    A single R master process that forks one child per job (POSIX only).
+
+    The master loads TRADEtools/ashr/mashr/arrow once and runs each job in a child created
+    with parallel::mcparallel, so concurrent jobs share the package memory copy-on-write
+    instead of each worker holding its own copy. Each child replies on its own FIFO (see
+    _ReplyChannel), and a child whose call is cancelled or fails is killed, so at most
+    size jobs run at once. Offers the same start/close/call interface as RWorkerPool.
+    """
+
+    def __init__(self, size: int = min(os.cpu_count() or 1, MAX_WORKERS),
+                 idle_timeout: float = WORKER_IDLE_TIMEOUT):
+        self.idle_timeout = idle_timeout
+        self._slots = asyncio.Semaphore(max(size, 1))
+        self._lock = asyncio.Lock()
+        self._master = None
+        self._job_ids = itertools.count()
+        self._reply_dir = tempfile.mkdtemp(prefix="trade_replies_")
+        atexit.register(shutil.rmtree, self._reply_dir, ignore_errors=True)
+        self.last_used = time.monotonic()
+
+    @property
+    def running(self) -> bool:
+        return self._master is not None and self._master.proc.returncode is None
+
+    @staticmethod
+    async def _read_replies(master: _ForkMaster):
+        try:
+            while (reply := await _read_record(master.proc.stdout)) is not None:
+                job_id = reply.pop("id", None)
+                if job_id in master.abandoned:
+                    master.abandoned.discard(job_id)
+                    if "pid" in reply:
+                        _kill_child(reply["pid"])
+                    continue
+                future = master.pending.get(job_id)
+                if future is not None and not future.done():
+                    future.set_result(reply)
+        finally:
+            # Without this reader fork failures would go unanswered, so retire the master;
+            # the next call starts a new one
+            if master.proc.returncode is None:
+                master.proc.kill()
+
+    @staticmethod
+    async def _watch_master(master: _ForkMaster):
+        error = RuntimeError(await master.stderr.format(f"R master exited unexpectedly with code {await _exited(master.proc)}"))
+        for future in master.pending.values():
+            if not future.done():
+                future.set_exception(error)
+
+    async def _ensure_started(self):
+        # Callers hold _lock, so the reaper cannot stop the master mid-dispatch
+        if self.running:
+            return
+        proc, stderr = await _spawn("--fork")
+        # The master announces itself once its packages are loaded
+        if await _read_record(proc.stdout) is None:
+            raise RuntimeError(await stderr.format(f"R master exited unexpectedly with code {await _exited(proc)}"))
+        self._master = _ForkMaster(proc, stderr)
+        asyncio.create_task(self._read_replies(self._master))
+        asyncio.create_task(self._watch_master(self._master))
+
+    async def start(self):
+        """Start the master (if needed) and wait until its packages are loaded."""
+        self._ensure_reaper()
+        async with self._lock:
+            await self._ensure_started()
+
+    async def _stop_idle(self, now: float):
+        async with self._lock:
+            if self.running and not self._master.pending and now - self.last_used > self.idle_timeout:
+                await _stop_process(self._master.proc)
+
+    async def close(self):
+        """Stop the reaper and the master process."""
+        self._cancel_reaper()
+        async with self._lock:
+            if self.running:
+                await _stop_process(self._master.proc)
+
+    @staticmethod
+    async def _read_child_reply(channel: _ReplyChannel) -> dict:
+        try:
+            await asyncio.wait_for(channel.wait_opened(), CHILD_ACK_TIMEOUT)
+        except asyncio.TimeoutError:
+            raise RuntimeError(f"R child process did not open its reply channel within {CHILD_ACK_TIMEOUT} s") from None
+        reply = await channel.read_reply()
+        if reply is None:
+            return {"error": "R child process exited without replying (killed, e.g. by the OOM killer, or crashed)"}
+        return reply
+
+    async def call(self, job: str, args: dict) -> dict:
+        """Run a job in a forked child, waiting for a free slot if necessary."""
+        self._ensure_reaper()
+        async with self._slots:
+            job_id = next(self._job_ids)
+            channel = _ReplyChannel(os.path.join(self._reply_dir, f"job_{job_id}"))
+            master = child = reply = None
+            try:
+                await channel.open()
+                async with self._lock:
+                    await self._ensure_started()
+                    master = self._master
+                    dispatched = master.pending[job_id] = asyncio.get_running_loop().create_future()
+                    since = master.stderr.mark()
+                    request = {"id": job_id, "job": job, "args": args, "reply": channel.path}
+                    master.proc.stdin.write(json.dumps(request).encode() + b"\n")
+                    await master.proc.stdin.drain()
+                started = await dispatched
+                if "error" in started:
+                    reply = started
+                else:
+                    child = started["pid"]
+                    reply = await self._read_child_reply(channel)
+            finally:
+                if master is not None:
+                    del master.pending[job_id]
+                    if reply is None:
+                        # Cancelled or failed while the child may still be running: kill it,
+                        # so it does not run outside the slot limit or block on a removed FIFO
+                        if child is not None:
+                            _kill_child(child)
+                        else:
+                            master.abandoned.add(job_id)
+                channel.close()
+                self.last_used = time.monotonic()
+
+        if "error" in reply:
+            raise RuntimeError(await master.stderr.format(
+                f"TRADE {job} analysis failed: {reply['error']}", since, shared=True))
+        return reply["result"]
+
+
+# Shared by both tools; started by the MCP server lifespan, or lazily on first call
+worker_pool = RForkServer() if USE_FORK else RWorkerPool()
@@ -1,20 +1,261 @@
 """MCP tools for TRADEtools - Transcriptome-wide Analysis of Differential Expression"""
 
-import subprocess
+import asyncio
+import atexit
+import csv
+import hashlib
+import itertools
+import json
+import os
+import shutil
 import tempfile
-from pathlib import Path
-from typing import Annotated, Optional
-import pandas as pd
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Annotated, Literal, Optional, Union
+import numpy as np
+import pyarrow.csv
+import pyarrow.feather
+import pyarrow.types
 from mcp.server.fastmcp import FastMCP
 
+if __package__:
+    from tools.r_worker import worker_pool
+else:
+    # Run directly as a script (python tools/tradetools_intro.py); r_worker.py sits alongside
+    from r_worker import worker_pool
+
 mcp = FastMCP("tradetools-intro")
 
-# Point to the R scripts directory for this tutorial
-R_SCRIPT_DIR = Path(__file__).parent.parent / "r_scripts" / "tradetools_intro"
+REFERENCE_URL = "https://github.com/SONGDONGYUAN1994/TRADEtools/blob/main/vignettes/TRADEtools-intro.Rmd"
+
+
+@dataclass(frozen=True)
+class UnivariateResult:
+    """Result of trade_univariate, validated and serialized by FastMCP; R NA values are None."""
+    transcriptome_wide_impact: Optional[float]
+    Me: Optional[float]
+    mean: Optional[float]
+    enrichments: Optional[dict[str, Optional[float]]] = None
+    sample_summary: Optional[dict[str, dict[str, Optional[float]]]] = None
+    result_rds: Optional[str] = None
+    result_parquet: Optional[str] = None
+    log_path: Optional[str] = None
+    message: str = "TRADE univariate analysis completed"
+    reference: str = REFERENCE_URL
+
+
+@dataclass(frozen=True)
+class BivariateResult:
+    """Result of trade_bivariate, validated and serialized by FastMCP; R NA values are None."""
+    TI_correlation: Optional[float]
+    cor_raw: Optional[float]
+    loglik: Optional[float]
+    sample_summary: Optional[dict[str, dict[str, Optional[float]]]] = None
+    result_rds: Optional[str] = None
+    result_parquet: Optional[str] = None
+    log_path: Optional[str] = None
+    message: str = "TRADE bivariate analysis completed"
+    reference: str = REFERENCE_URL
+
+
+def _parse_gene_list(genes: str) -> list[str]:
+    """Split a comma-separated gene list, dropping blanks and duplicates."""
+    return list(dict.fromkeys(gene.strip() for gene in genes.split(",") if gene.strip()))
+
+
+# Recent tool results keyed by input file contents and parameters (LRU)
+_RESULT_CACHE_SIZE = 64
+_result_cache: OrderedDict[str, Union[UnivariateResult, BivariateResult]] = OrderedDict()
+
+# Input file digests by path, reused while (mtime, size) are unchanged
+_digest_cache: dict[str, tuple[int, int, str]] = {}
+
+
+def _file_digest(path: str) -> str:
+    """BLAKE2b digest of a file's contents, re-hashed only when its mtime or size changes."""
+    path = os.path.abspath(path)
+    stat = os.stat(path)
+    cached = _digest_cache.get(path)
+    if cached is not None and cached[:2] == (stat.st_mtime_ns, stat.st_size):
+        return cached[2]
+    digest = hashlib.blake2b()
+    with open(path, "rb") as f:
+        while chunk := f.read(1 << 20):
+            digest.update(chunk)
+    _digest_cache[path] = (stat.st_mtime_ns, stat.st_size, digest.hexdigest())
+    return _digest_cache[path][2]
+
+
+async def _cache_key(job: str, args: dict, files: dict[str, Optional[str]]) -> str:
+    """Key a job by its parameters plus the content digests of its input files."""
+    keyed = dict(args)
+    for name, path in files.items():
+        keyed[name] = await asyncio.to_thread(_file_digest, path) if path else None
+    return json.dumps([job, keyed], sort_keys=True)
+
+
+def _cache_get(key: str) -> Optional[Union[UnivariateResult, BivariateResult]]:
+    """Return a cached result if present and its output files still exist."""
+    result = _result_cache.get(key)
+    if result is None:
+        return None
+    if any((path := getattr(result, name, None)) and not os.path.exists(path)
+           for name in ("result_rds", "result_parquet", "log_path")):
+        del _result_cache[key]
+        return None
+    _result_cache.move_to_end(key)
+    return result
+
+
+def _cache_put(key: str, result: Union[UnivariateResult, BivariateResult]):
+    _result_cache[key] = result
+    if len(_result_cache) > _RESULT_CACHE_SIZE:
+        _result_cache.popitem(last=False)
+
+
+# Output files for this server session; removed when the server exits
+_SESSION_TMPDIR = tempfile.mkdtemp(prefix="trade_mcp_")
+atexit.register(shutil.rmtree, _SESSION_TMPDIR, ignore_errors=True)
+_output_counter = itertools.count()
+
+
+def _lazy_output_path(suffix: str) -> str:
+    """Name a new output file in the session directory; only called on paths that write it."""
+    return os.path.join(_SESSION_TMPDIR, f"trade_{next(_output_counter)}{suffix}")
+
+
+def _csv_read_options(path: str) -> pyarrow.csv.ReadOptions:
+    """
+    pyarrow read options for an input CSV.
+
+    R's write.table(sep = ",") leaves the rownames column out of the header, so data rows
+    have one field more than the header; like fread, accept that, and name the column "rn"
+    so the R scripts use it for rownames.
+    """
+    with open(path, newline="") as f:
+        rows = list(itertools.islice(csv.reader(f), 2))
+    if len(rows) == 2 and len(rows[1]) == len(rows[0]) + 1:
+        return pyarrow.csv.ReadOptions(column_names=["rn", *rows[0]], skip_rows=1)
+    return pyarrow.csv.ReadOptions()
+
+
+def _read_annotation_table(annot_table_csv: str) -> pyarrow.Table:
+    """Parse an annotation table: gene IDs in the first column, numeric 0/1 annotations in the rest."""
+    try:
+        annot = pyarrow.csv.read_csv(annot_table_csv, read_options=_csv_read_options(annot_table_csv))
+    except pyarrow.ArrowInvalid as e:
+        raise ValueError(f"Could not parse annotation table {annot_table_csv}: {e}") from e
+    non_numeric = [field.name for field in list(annot.schema)[1:]
+                   if not (pyarrow.types.is_integer(field.type) or pyarrow.types.is_floating(field.type)
+                           or pyarrow.types.is_boolean(field.type))]
+    if non_numeric:
+        raise ValueError(f"Annotation columns {non_numeric} in {annot_table_csv} are not numeric; "
+                         "expected gene IDs in the first column and 0/1 annotations in the others")
+    return annot
+
+
+def _validate_inputs(results_csvs: tuple[str, ...], value_columns: tuple[str, ...],
+                     annot_table_csv: Optional[str] = None):
+    """Fail fast on missing files or columns, before any R work is dispatched (blocking I/O)."""
+    for path in (*results_csvs, annot_table_csv):
+        if path and not os.path.isfile(path):
+            raise ValueError(f"Input file not found: {path}")
+    for path in results_csvs:
+        if not path.endswith(".csv"):
+            continue
+        # Only the header and first block are parsed
+        try:
+            reader = pyarrow.csv.open_csv(path, read_options=_csv_read_options(path))
+        except pyarrow.ArrowInvalid as e:
+            raise ValueError(f"Could not parse results CSV {path}: {e}") from e
+        try:
+            names = reader.schema.names
+        finally:
+            reader.close()
+        missing = [name for name in value_columns if name not in names]
+        if missing:
+            raise ValueError(f"Columns {missing} not found in {path}; available columns: {names}")
+    if annot_table_csv:
+        # Parsed in full, so a bad table fails now rather than after the TRADE fit
+        _read_annotation_table(annot_table_csv)
+
+
+def _validate_sampling(n_sample: int, sample_chunk_size: int):
+    """Check the sampling options here rather than in R after the full TRADE fit."""
+    if n_sample < 0:
+        raise ValueError(f"n_sample must be >= 0 (0 = no sampling), got {n_sample}")
+    if sample_chunk_size <= 0:
+        raise ValueError(f"sample_chunk_size must be a positive number of rows, got {sample_chunk_size}")
+
+
+def _results_to_feather(results_csv: str, value_columns: tuple[str, ...]) -> str:
+    """
+    Parse a results CSV with pyarrow's multithreaded reader and save it as uncompressed
+    Feather, so R loads typed columns instead of re-parsing the CSV itself.
+    """
+    try:
+        table = pyarrow.csv.read_csv(
+            results_csv, read_options=_csv_read_options(results_csv),
+            convert_options=pyarrow.csv.ConvertOptions(
+                column_types={name: pyarrow.float64() for name in value_columns}))
+    except pyarrow.ArrowInvalid as e:
+        # Rows past the first block are only parsed here, after _validate_inputs
+        raise ValueError(f"Could not parse results CSV {results_csv}: {e}") from e
+    if table.column_names[0] == "":
+        # An unnamed first column holds the gene IDs; the R scripts take rownames from "rn"
+        table = table.rename_columns(["rn", *table.column_names[1:]])
+    feather_path = _lazy_output_path(".feather")
+    pyarrow.feather.write_feather(table, feather_path, compression="uncompressed")
+    return feather_path
+
+
+async def _prefilter_results(args: dict, names: tuple[str, ...], value_columns: tuple[str, ...]) -> list[str]:
+    """Swap the CSV inputs in args for Feather copies; returns the copies to delete afterwards."""
+    converted = []
+    for name in names:
+        if args[name].endswith(".csv"):
+            args[name] = await asyncio.to_thread(_results_to_feather, args[name], value_columns)
+            converted.append(args[name])
+    return converted
+
+
+def _posterior_enrichments(posterior_feather: str, annot_table_csv: str) -> dict[str, Optional[float]]:
+    """
+    Enrichment of transcriptome-wide impact in each annotation.
+
+    For every annotation this is the mean posterior E[beta^2] of its genes relative to the
+    mean over all annotated genes. All annotations are scored at once with matrix-vector
+    products over the binary annotation table, instead of one R fit per annotation.
+    """
+    posterior = pyarrow.feather.read_table(posterior_feather, columns=["gene", "posterior_m2"])
+    annot = _read_annotation_table(annot_table_csv)
+    names = annot.column_names[1:]
+
+    # Align annotation rows (gene IDs in the first column) to the posterior genes
+    row_of = {gene: i for i, gene in enumerate(posterior.column("gene").to_pylist())}
+    rows = np.array([row_of.get(str(gene), -1) for gene in annot.column(0).to_pylist()], dtype=np.int64)
+    matched = rows >= 0
+    if not matched.any():
+        raise ValueError(
+            f"No gene IDs in the first column of {annot_table_csv} match the results rownames "
+            f"(e.g. {annot.column(0)[0].as_py()!r} vs {posterior.column('gene')[0].as_py()!r}); the gene IDs in the "
+            "results must be in a first column that is unnamed or named 'rn' to be used as rownames")
+    m2 = np.zeros(annot.num_rows)
+    m2[matched] = posterior.column("posterior_m2").to_numpy()[rows[matched]]
+
+    membership = np.empty((annot.num_rows, len(names)))
+    for k, name in enumerate(names):
+        # Blank cells mean the gene is not annotated with that set
+        membership[:, k] = annot.column(name).cast(pyarrow.float64()).fill_null(0).to_numpy()
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        set_mean = (membership.T @ m2) / (membership.T @ matched)
+        enrichment = set_mean / m2[matched].mean()
+    return {name: float(value) if np.isfinite(value) else None for name, value in zip(names, enrichment)}
 
 
 @mcp.tool()
-def trade_univariate(
+async def trade_univariate(
     results_csv: Annotated[str,
         "Path to CSV file with DESeq2 differential expression results. "
         "Required columns: log2FoldChange (effect sizes), lfcSE (standard errors), pvalue (unadjusted p-values). "
@@ -30,15 +271,27 @@ def trade_univariate(
         "Column name for log2FoldChange standard errors in results CSV."] = "lfcSE",
     pvalue_col: Annotated[str,
         "Column name for unadjusted p-values in results CSV."] = "pvalue",
+    enrichment_method: Annotated[Literal["posterior", "trade"],
+        "How to compute annotation enrichments when annot_table_csv is given. "
+        "'posterior': enrichment of transcriptome-wide impact from per-gene posterior effects, computed in Python (fast). "
+        "'trade': TRADEtools' own enrichment analysis in R, saved in result_rds."] = "posterior",
     model_significant: Annotated[bool,
-        "Whether to model significant genes separately and compute fraction of signal in significant genes."] = True,
+        "Whether to model significant genes separately and compute fraction of signal in significant genes "
+        "(part of the full TRADE result; see save_full_result)."] = True,
     genes_exclude: Annotated[Optional[str],
         "Comma-separated list of gene IDs to exclude from analysis (e.g., perturbed genes themselves)."] = None,
     n_sample: Annotated[int,
         "Number of samples to draw from the inferred effect size distribution (0 = no sampling)."] = 0,
+    sample_chunk_size: Annotated[int,
+        "Rows of samples per Parquet row group when n_sample > 0; result_parquet can be streamed chunk by chunk."] = 1000,
     seed: Annotated[int,
         "Random seed for reproducibility."] = 42,
-) -> dict:
+    verbose: Annotated[bool,
+        "Write TRADE fitting diagnostics to a log file, returned as log_path."] = False,
+    save_full_result: Annotated[bool,
+        "Save the full TRADE result (fitted distribution, significant gene results, enrichments) "
+        "as an RDS file, returned as result_rds."] = False,
+) -> UnivariateResult:
     """
     Run univariate TRADE analysis to estimate transcriptome-wide impact of a perturbation.
 
@@ -50,48 +303,94 @@ def trade_univariate(
 
     The method uses adaptive shrinkage (ashr) to model the effect size distribution as a
     mixture of half-uniform components, accounting for measurement uncertainty.
+
+    When an annotation table is given, enrichments are returned directly by default; with
+    enrichment_method='trade' they are computed by TRADE and saved, with the full TRADE
+    result, to result_rds. The full result, including the fraction of signal in significant
+    genes, is also saved there when save_full_result is set.
+
+    When n_sample > 0, the sampled effect sizes are saved to result_parquet in row groups of
+    sample_chunk_size rows (zstd-compressed; stream it with
+    pyarrow.parquet.ParquetFile(...).iter_batches()), and their per-column mean and sd are
+    returned as sample_summary. Either path is None when not requested. Output files are kept
+    until the server exits.
     """
-    with tempfile.NamedTemporaryFile(suffix=".csv", delete=False) as f:
-        output_csv = f.name
-
-    cmd = [
-        "Rscript", str(R_SCRIPT_DIR / "trade_univariate.R"),
-        "--results", results_csv,
-        "--log2FoldChange", log2FoldChange_col,
-        "--lfcSE", lfcSE_col,
-        "--pvalue", pvalue_col,
-        "--model_significant", str(model_significant).upper(),
-        "--n_sample", str(n_sample),
-        "--seed", str(seed),
-        "--output", output_csv
-    ]
+    value_columns = (log2FoldChange_col, lfcSE_col, pvalue_col)
+    await asyncio.to_thread(_validate_inputs, (results_csv,), value_columns, annot_table_csv)
+    _validate_sampling(n_sample, sample_chunk_size)
 
-    if annot_table_csv:
-        cmd.extend(["--annot_table", annot_table_csv])
+    args = {
+        "results": results_csv,
+        "log2FoldChange": log2FoldChange_col,
+        "lfcSE": lfcSE_col,
+        "pvalue": pvalue_col,
+        "model_significant": model_significant,
+        "n_sample": n_sample,
+        "sample_chunk_size": sample_chunk_size,
+        "seed": seed,
+        "verbose": verbose,
+    }
+
+    if annot_table_csv and enrichment_method == "trade":
+        args["annot_table"] = annot_table_csv
 
     if genes_exclude:
-        cmd.extend(["--genes_exclude", genes_exclude])
+        # Sent as a JSON array over the worker's stdin, so long lists never hit argv
+        args["genes_exclude"] = _parse_gene_list(genes_exclude)
 
-    subprocess.run(cmd, check=True)
+    # Identical inputs and parameters give identical results, so skip R entirely on a hit
+    cache_key = await _cache_key(
+        "univariate", {**args, "enrichment_method": enrichment_method, "save_full_result": save_full_result},
+        files={"results": results_csv, "annot_table": annot_table_csv},
+    )
+    if (cached := _cache_get(cache_key)) is not None:
+        return cached
 
-    result_df = pd.read_csv(output_csv)
-    result_rds = output_csv.replace(".csv", ".rds")
-    Path(output_csv).unlink()
+    # The full result is only written when asked for, or when it holds the enrichments
+    result_rds = None
+    if save_full_result or "annot_table" in args:
+        result_rds = args["rds"] = _lazy_output_path(".rds")
 
-    result = result_df.to_dict(orient="records")[0]
+    posterior_feather = None
+    if annot_table_csv and enrichment_method == "posterior":
+        posterior_feather = args["posterior"] = _lazy_output_path(".feather")
 
-    return {
-        "message": "TRADE univariate analysis completed",
-        "reference": "https://github.com/SONGDONGYUAN1994/TRADEtools/blob/main/vignettes/TRADEtools-intro.Rmd",
-        "transcriptome_wide_impact": float(result["transcriptome_wide_impact"]),
-        "Me": float(result["Me"]),
-        "mean": float(result["mean"]),
-        "result_rds": result_rds,
-    }
+    result_parquet = None
+    if n_sample > 0:
+        result_parquet = args["parquet"] = _lazy_output_path(".parquet")
+
+    log_path = None
+    if verbose:
+        log_path = args["log"] = _lazy_output_path(".log")
+
+    converted = await _prefilter_results(args, ("results",), value_columns)
+    try:
+        result = await worker_pool.call("univariate", args)
+    finally:
+        for path in converted:
+            os.unlink(path)
+
+    enrichments = None
+    if posterior_feather:
+        try:
+            enrichments = await asyncio.to_thread(_posterior_enrichments, posterior_feather, annot_table_csv)
+        finally:
+            os.unlink(posterior_feather)
+
+    response = UnivariateResult(
+        **{name: result.get(name) for name in ("transcriptome_wide_impact", "Me", "mean")},
+        enrichments=enrichments,
+        sample_summary=result.get("sample_summary") or None,
+        result_rds=result_rds,
+        result_parquet=result_parquet,
+        log_path=log_path,
+    )
+    _cache_put(cache_key, response)
+    return response
 
 
 @mcp.tool()
-def trade_bivariate(
+async def trade_bivariate(
     results1_csv: Annotated[str,
         "Path to CSV file with first DESeq2 differential expression results. "
         "Same format requirements as univariate mode."],
@@ -116,9 +415,16 @@ def trade_bivariate(
         "Prior weight on 0-correlation component (1 = no penalty, >1 = penalty on correlation)."] = 1.0,
     n_sample: Annotated[int,
         "Number of samples to draw from the inferred effect size distribution (0 = no sampling)."] = 0,
+    sample_chunk_size: Annotated[int,
+        "Rows of samples per Parquet row group when n_sample > 0; result_parquet can be streamed chunk by chunk."] = 1000,
     seed: Annotated[int,
         "Random seed for reproducibility."] = 42,
-) -> dict:
+    verbose: Annotated[bool,
+        "Write TRADE fitting diagnostics to a log file, returned as log_path."] = False,
+    save_full_result: Annotated[bool,
+        "Save the full TRADE result (including the inferred covariance/correlation matrices) "
+        "as an RDS file, returned as result_rds."] = False,
+) -> BivariateResult:
     """
     Run bivariate TRADE analysis to estimate correlation of differential expression effects
     between two perturbations.
@@ -126,49 +432,77 @@ def trade_bivariate(
     TRADE bivariate mode estimates the joint distribution of effects and computes:
     - TI correlation: transcriptome-wide impact correlation (correlation of true effects)
     - Raw correlation: Pearson correlation of observed log2FoldChanges
-    - Covariance/correlation matrices: inferred effect size relationships
+    - Covariance/correlation matrices: inferred effect size relationships, saved to
+      result_rds with the full TRADE result when save_full_result is set
 
     This uses mashr (multivariate adaptive shrinkage) to jointly model the two sets of
     summary statistics, accounting for measurement uncertainty and potential sampling covariance.
+
+    When n_sample > 0, the sampled effect sizes are saved to result_parquet in row groups of
+    sample_chunk_size rows (zstd-compressed; stream it with
+    pyarrow.parquet.ParquetFile(...).iter_batches()), and their per-column mean and sd are
+    returned as sample_summary; otherwise result_parquet is None. Output files are kept
+    until the server exits.
     """
-    with tempfile.NamedTemporaryFile(suffix=".csv", delete=False) as f:
-        output_csv = f.name
-
-    cmd = [
-        "Rscript", str(R_SCRIPT_DIR / "trade_bivariate.R"),
-        "--results1", results1_csv,
-        "--results2", results2_csv,
-        "--log2FoldChange", log2FoldChange_col,
-        "--lfcSE", lfcSE_col,
-        "--pvalue", pvalue_col,
-        "--estimate_sampling_covariance", str(estimate_sampling_covariance).upper(),
-        "--covariance_matrix_set", covariance_matrix_set,
-        "--component_varexplained_threshold", str(component_varexplained_threshold),
-        "--weight_nocorr", str(weight_nocorr),
-        "--n_sample", str(n_sample),
-        "--seed", str(seed),
-        "--output", output_csv
-    ]
+    value_columns = (log2FoldChange_col, lfcSE_col, pvalue_col)
+    await asyncio.to_thread(_validate_inputs, (results1_csv, results2_csv), value_columns)
+    _validate_sampling(n_sample, sample_chunk_size)
+
+    args = {
+        "results1": results1_csv,
+        "results2": results2_csv,
+        "log2FoldChange": log2FoldChange_col,
+        "lfcSE": lfcSE_col,
+        "pvalue": pvalue_col,
+        "estimate_sampling_covariance": estimate_sampling_covariance,
+        "covariance_matrix_set": covariance_matrix_set,
+        "component_varexplained_threshold": component_varexplained_threshold,
+        "weight_nocorr": weight_nocorr,
+        "n_sample": n_sample,
+        "sample_chunk_size": sample_chunk_size,
+        "seed": seed,
+        "verbose": verbose,
+    }
 
     if genes_exclude:
-        cmd.extend(["--genes_exclude", genes_exclude])
+        # Sent as a JSON array over the worker's stdin, so long lists never hit argv
+        args["genes_exclude"] = _parse_gene_list(genes_exclude)
 
-    subprocess.run(cmd, check=True)
+    cache_key = await _cache_key(
+        "bivariate", {**args, "save_full_result": save_full_result},
+        files={"results1": results1_csv, "results2": results2_csv},
+    )
+    if (cached := _cache_get(cache_key)) is not None:
+        return cached
 
-    result_df = pd.read_csv(output_csv)
-    result_rds = output_csv.replace(".csv", ".rds")
-    Path(output_csv).unlink()
+    result_rds = None
+    if save_full_result:
+        result_rds = args["rds"] = _lazy_output_path(".rds")
 
-    result = result_df.to_dict(orient="records")[0]
+    result_parquet = None
+    if n_sample > 0:
+        result_parquet = args["parquet"] = _lazy_output_path(".parquet")
 
-    return {
-        "message": "TRADE bivariate analysis completed",
-        "reference": "https://github.com/SONGDONGYUAN1994/TRADEtools/blob/main/vignettes/TRADEtools-intro.Rmd",
-        "TI_correlation": float(result["TI_correlation"]),
-        "cor_raw": float(result["cor_raw"]),
-        "loglik": float(result["loglik"]),
-        "result_rds": result_rds,
-    }
+    log_path = None
+    if verbose:
+        log_path = args["log"] = _lazy_output_path(".log")
+
+    converted = await _prefilter_results(args, ("results1", "results2"), value_columns)
+    try:
+        result = await worker_pool.call("bivariate", args)
+    finally:
+        for path in converted:
+            os.unlink(path)
+
+    response = BivariateResult(
+        **{name: result.get(name) for name in ("TI_correlation", "cor_raw", "loglik")},
+        sample_summary=result.get("sample_summary") or None,
+        result_rds=result_rds,
+        result_parquet=result_parquet,
+        log_path=log_path,
+    )
+    _cache_put(cache_key, response)
+    return response
 
 
 if __name__ == "__main__":